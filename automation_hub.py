@@ -10,16 +10,31 @@ import json
 import re
 import threading
 import operator
-from dataclasses import dataclass, field, asdict
-from datetime import datetime, timedelta
-from typing import Any, Callable, Dict, List, Optional, Tuple
+import functools
+import copy
+import bisect
+import heapq
+import itertools
+import time
+from collections import deque
+from contextlib import contextmanager
+from dataclasses import dataclass, field, fields
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Deque, Dict, Iterator, List, Optional, Tuple
 from enum import Enum
 import logging
 
+try:
+    import orjson   # optional: faster JSON encode/decode on the hot paths
+except ImportError:
+    orjson = None
+
 logger = logging.getLogger(__name__)
 
 DB_PATH = "automation_hub.db"
-_LOCK = threading.Lock()
+_FLUSH_BATCH = 1000     # max rows per executemany when draining write queues
+_ts_cache: Tuple[int, str] = (0, "")   # (epoch second, its ISO string)
+_REDACT_KEYS = frozenset({"credentials"})   # context keys never persisted
 
 
 # ─────────────────────────── Enums & Types ──────────────────────────
@@ -66,7 +81,8 @@ _OP_MAP: Dict[str, Callable[[Any, Any], bool]] = {
 
 # ─────────────────────────── Dataclasses ────────────────────────────
 
-@dataclass
+
+@dataclass(slots=True)
 class Trigger:
     type: str                          # TriggerType value
     config: Dict[str, Any] = field(default_factory=dict)
@@ -77,32 +93,58 @@ class Trigger:
     # WEBHOOK:{"endpoint": "/webhooks/my_hook"}
 
 
-@dataclass
+@dataclass(slots=True)
 class Condition:
     field: str                # dot-path in context, e.g. "sensor.s1.value"
     op: str                   # ConditionOp value
     value: Any
     negate: bool = False
+    # Derived in __setattr__ from op/field; declared so they get slots
+    _fn: Callable[[Any, Any], bool] = field(init=False, repr=False, compare=False)
+    _parts: Tuple[str, ...] = field(init=False, repr=False, compare=False)
+    _getter: Callable[[Any], Any] = field(init=False, repr=False, compare=False)
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        # Resolved on assignment so a bad operator fails at rule load, not
+        # per event, and later edits to op/field still take effect
+        if name == "op":
+            fn = _OP_MAP.get(_enum_value(value))
+            if fn is None:
+                raise ValueError(f"Unknown condition operator: {value!r}")
+            object.__setattr__(self, "_fn", fn)
+        elif name == "field":
+            parts = _split_path(value)
+            object.__setattr__(self, "_parts", parts)
+            object.__setattr__(self, "_getter", _path_getter(parts))
+        object.__setattr__(self, name, value)
+
+    # Pickle only the plain fields: the derived slots may hold eval-built
+    # callables, and assigning field/op on load rebuilds them anyway.
+    def __getstate__(self) -> tuple:
+        return (self.field, self.op, self.value, self.negate)
+
+    def __setstate__(self, state: tuple) -> None:
+        self.field, self.op, self.value, self.negate = state
 
     def evaluate(self, context: Dict[str, Any]) -> bool:
-        actual = _resolve_path(self.field, context)
+        try:
+            actual = self._getter(context)
+        except (KeyError, TypeError, IndexError):
+            return self.negate
         if actual is None:
             return self.negate   # missing field → condition fails (or passes if negated)
-        fn = _OP_MAP.get(self.op)
-        if fn is None:
-            raise ValueError(f"Unknown condition operator: {self.op!r}")
-        result = fn(actual, self.value)
+        result = self._fn(actual, self.value)
         return (not result) if self.negate else result
 
 
-@dataclass
+@dataclass(slots=True)
 class Action:
     type: str                  # ActionType value
     target: Optional[str] = None
     params: Dict[str, Any] = field(default_factory=dict)
 
 
-@dataclass
+@dataclass(slots=True)
 class Rule:
     name: str
     trigger: Trigger
@@ -114,9 +156,38 @@ class Rule:
     created_at: str = field(default_factory=lambda: datetime.utcnow().isoformat())
     last_triggered: Optional[str] = None
     trigger_count: int = 0
+    # Compiled all-conditions check, set when the rule enters the rule cache
+    _eval_fn: Optional[Callable[[Dict[str, Any]], bool]] = field(
+        init=False, default=None, repr=False, compare=False)
+
+    # The compiled _eval_fn is exec-built and doesn't pickle; it is rebuilt
+    # when the rule next enters the rule cache.
+    def __getstate__(self) -> dict:
+        return {f.name: getattr(self, f.name) for f in fields(self) if f.init}
+
+    def __setstate__(self, state: dict) -> None:
+        for name, value in state.items():
+            setattr(self, name, value)
+        self._eval_fn = None
 
     def to_dict(self) -> dict:
-        return asdict(self)
+        # Built by hand: asdict() deep-copies the whole tree and would also
+        # pick up the derived Condition fields.
+        return {
+            "name": self.name,
+            "trigger": {"type": self.trigger.type,
+                        "config": dict(self.trigger.config)},
+            "conditions": [{"field": c.field, "op": c.op, "value": c.value,
+                            "negate": c.negate} for c in self.conditions],
+            "actions": [{"type": a.type, "target": a.target,
+                         "params": dict(a.params)} for a in self.actions],
+            "enabled": self.enabled,
+            "priority": self.priority,
+            "description": self.description,
+            "created_at": self.created_at,
+            "last_triggered": self.last_triggered,
+            "trigger_count": self.trigger_count,
+        }
 
     @classmethod
     def from_dict(cls, d: dict) -> "Rule":
@@ -135,41 +206,424 @@ class Rule:
         )
 
 
+# ─────────────────────────── Threshold tables ───────────────────────
+
+_NUMERIC_OPS = frozenset({"==", "!=", ">", ">=", "<", "<="})
+
+
+def _is_number(v: Any) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool)
+
+
+def _sensor_threshold(cond: Condition) -> Optional[str]:
+    """Sensor id if cond is a plain numeric test on 'sensor.<id>.value'."""
+    parts = cond._parts
+    if (len(parts) == 3 and parts[0] == "sensor" and parts[2] == "value"
+            and not cond.negate and _enum_value(cond.op) in _NUMERIC_OPS
+            and _is_number(cond.value)
+            and cond.value == cond.value):   # NaN would break the sort order
+        return parts[1]
+    return None
+
+
+@dataclass
+class _ThresholdTable:
+    """Numeric threshold conditions on one sensor, sorted per operator.
+
+    Only rules whose every condition is such a threshold are included. Each
+    operator keeps its thresholds sorted, so one bisect per operator finds
+    the slice of conditions that fail for a value; passing conditions are
+    never visited.
+    """
+    rules: List[Rule] = field(default_factory=list)
+    # op → (sorted thresholds, aligned (rule_idx, cond_idx, description))
+    groups: Dict[str, Tuple[List[float], List[Tuple[int, int, str]]]] = \
+        field(default_factory=dict)
+
+    def add(self, rule: Rule) -> None:
+        idx = len(self.rules)
+        self.rules.append(rule)
+        for cond_idx, cond in enumerate(rule.conditions):
+            thresholds, entries = self.groups.setdefault(
+                _enum_value(cond.op), ([], []))
+            pos = bisect.bisect_right(thresholds, cond.value)
+            thresholds.insert(pos, cond.value)
+            entries.insert(pos, (idx, cond_idx, f"{cond.field} {cond.op} {cond.value}"))
+
+    def match(self, value: float) -> Optional[Dict[int, List[str]]]:
+        """Map id(rule) → descriptions of its thresholds that fail for value."""
+        if value != value:
+            return None   # NaN does not order; leave it to the generic path
+        failing: List[Tuple[int, int, str]] = []
+        for op, (ts, entries) in self.groups.items():
+            lo = bisect.bisect_left(ts, value)
+            hi = bisect.bisect_right(ts, value)
+            if op == ">":
+                failing += entries[lo:]
+            elif op == ">=":
+                failing += entries[hi:]
+            elif op == "<":
+                failing += entries[:hi]
+            elif op == "<=":
+                failing += entries[:lo]
+            elif op == "==":
+                failing += entries[:lo]
+                failing += entries[hi:]
+            else:   # "!="
+                failing += entries[lo:hi]
+        failed: List[List[str]] = [[] for _ in self.rules]
+        for idx, _, desc in sorted(failing):
+            failed[idx].append(desc)
+        return {id(r): f for r, f in zip(self.rules, failed)}
+
+
+def _build_threshold_tables(rules: List[Rule]) -> Dict[str, _ThresholdTable]:
+    tables: Dict[str, _ThresholdTable] = {}
+    for rule in rules:
+        sensors = {_sensor_threshold(c) for c in rule.conditions}
+        if len(sensors) != 1 or None in sensors:
+            continue
+        tables.setdefault(sensors.pop(), _ThresholdTable()).add(rule)
+    return tables
+
+
+# ─────────────────────────── Rule compilation ───────────────────────
+
+# Inline forms of the _OP_MAP operators; any operator missing here is
+# compiled as a call to its _OP_MAP function.
+_OP_EXPR: Dict[str, str] = {
+    "==": "a == {v}",
+    "!=": "a != {v}",
+    ">":  "a > {v}",
+    ">=": "a >= {v}",
+    "<":  "a < {v}",
+    "<=": "a <= {v}",
+    "in": "a in {v}",
+    "contains": "{v} in a",
+}
+
+
+def _compile_conditions(rule: Rule) -> Callable[[Dict[str, Any]], bool]:
+    """Generate one function testing all of rule's conditions in sequence.
+
+    Paths become literal subscript chains and operators become inline
+    expressions where _OP_EXPR has one; condition values are bound as
+    globals of the generated code.
+    The function only answers pass/fail and may raise where a comparison
+    does — evaluate_rule falls back to per-condition evaluation then.
+    """
+    env: Dict[str, Any] = {}
+    lines = ["def _eval(ctx):"]
+    for i, cond in enumerate(rule.conditions):
+        v = f"_v{i}"
+        env[v] = cond.value
+        path = "".join(f"[{part!r}]" for part in cond._parts)
+        expr = _OP_EXPR.get(_enum_value(cond.op))
+        if expr is None:
+            # No inline form: call the operator's _OP_MAP function instead
+            env[f"_f{i}"] = cond._fn
+            test = f"_f{i}(a, {v})"
+        else:
+            test = expr.format(v=v)
+        lines += [
+            "    try:",
+            f"        a = ctx{path}",
+            "    except (KeyError, TypeError, IndexError):",
+            "        a = None",
+            (f"    if a is not None and ({test}): return False" if cond.negate
+             else f"    if a is None or not ({test}): return False"),
+        ]
+    lines.append("    return True")
+    exec(compile("\n".join(lines), f"<rule:{rule.name}>", "exec"), env)
+    return env["_eval"]
+
+
 # ─────────────────────────── Helpers ────────────────────────────────
 
-def _resolve_path(path: str, context: Dict[str, Any]) -> Any:
-    """Resolve dot-separated path in nested dict. e.g. 'sensor.s1.value'"""
-    parts = path.split(".")
-    val: Any = context
-    for part in parts:
-        if isinstance(val, dict):
-            val = val.get(part)
+@functools.lru_cache(maxsize=4096)
+def _split_path(path: str) -> Tuple[str, ...]:
+    return tuple(path.split("."))
+
+
+@functools.lru_cache(maxsize=4096)
+def _path_getter(parts: Tuple[str, ...]) -> Callable[[Any], Any]:
+    """Getter for a pre-split path as one subscript chain, e.g. c['a']['b'].
+
+    Raises KeyError/TypeError/IndexError where a level is missing.
+    """
+    if len(parts) == 1:
+        return operator.itemgetter(parts[0])
+    src = "lambda c: c" + "".join(f"[{part!r}]" for part in parts)
+    return eval(compile(src, f"<path:{'.'.join(parts)}>", "eval"), {})
+
+
+def _now_iso() -> str:
+    """Current UTC time as ISO string, at one-second resolution.
+
+    The formatted string is cached and only rebuilt when the second changes.
+    """
+    global _ts_cache
+    sec = int(time.time())
+    cached = _ts_cache
+    if sec != cached[0]:
+        stamp = datetime.fromtimestamp(sec, timezone.utc).replace(tzinfo=None)
+        cached = _ts_cache = (sec, stamp.isoformat())
+    return cached[1]
+
+
+if orjson is not None:
+    def _dumps(obj: Any) -> str:
+        """Compact JSON for storage columns."""
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    _loads = orjson.loads
+else:
+    def _dumps(obj: Any) -> str:
+        """Compact JSON for storage columns."""
+        return json.dumps(obj, separators=(",", ":"))
+
+    _loads = json.loads
+
+
+def _enum_value(v: Any) -> Any:
+    """Plain value of a str-Enum member, so it hashes like the raw string."""
+    return v.value if isinstance(v, Enum) else v
+
+
+def _index_by_config(rules: List[Rule], key: str) -> Dict[Any, List[Rule]]:
+    """Bucket rules by trigger.config[key], keeping their order.
+
+    Rules without the key match any value: they sit under None and are also
+    merged into every other bucket.
+    """
+    index: Dict[Any, List[Rule]] = {None: []}
+    for r in rules:
+        index.setdefault(r.trigger.config.get(key), [])
+    for r in rules:
+        k = r.trigger.config.get(key)
+        if k is None:
+            for bucket in index.values():
+                bucket.append(r)
         else:
-            return None
-    return val
+            index[k].append(r)
+    return index
 
 
 # ─────────────────────────── Database ───────────────────────────────
 
+# Statement text is kept at module level so every call hands sqlite3 the same
+# string and hits the connection's prepared-statement cache.
+SQL_INSERT_RULE = ("INSERT OR REPLACE INTO rules "
+                   "(name, trigger_type, trigger_config, enabled, priority, "
+                   "description, created_at, last_triggered, trigger_count) "
+                   "VALUES (?,?,?,?,?,?,?,?,?)")
+SQL_INSERT_CONDITION = ("INSERT INTO rule_conditions "
+                        "(rule_name, idx, field, op, value, negate) "
+                        "VALUES (?,?,?,?,?,?)")
+SQL_INSERT_ACTION = ("INSERT INTO rule_actions "
+                     "(rule_name, idx, type, target, params) VALUES (?,?,?,?,?)")
+# Rule reads return plain tuples in this column order (see _rules_from_rows)
+_RULE_COLS = ("name, trigger_type, trigger_config, enabled, priority, "
+              "description, created_at, last_triggered, trigger_count")
+SQL_SELECT_RULE = f"SELECT {_RULE_COLS} FROM rules WHERE name=?"
+SQL_SELECT_CONDITIONS = ("SELECT rule_name, field, op, value, negate "
+                         "FROM rule_conditions WHERE rule_name=? ORDER BY idx")
+SQL_SELECT_ACTIONS = ("SELECT rule_name, type, target, params "
+                      "FROM rule_actions WHERE rule_name=? ORDER BY idx")
+SQL_SELECT_ACTIVE = (f"SELECT {_RULE_COLS} FROM rules "
+                     "WHERE enabled=1 ORDER BY priority DESC")
+SQL_SELECT_ACTIVE_CONDITIONS = ("SELECT c.rule_name, c.field, c.op, c.value, c.negate "
+                                "FROM rule_conditions c "
+                                "JOIN rules r ON r.name=c.rule_name "
+                                "WHERE r.enabled=1 ORDER BY c.rule_name, c.idx")
+SQL_SELECT_ACTIVE_ACTIONS = ("SELECT a.rule_name, a.type, a.target, a.params "
+                             "FROM rule_actions a "
+                             "JOIN rules r ON r.name=a.rule_name "
+                             "WHERE r.enabled=1 ORDER BY a.rule_name, a.idx")
+SQL_SET_ENABLED = "UPDATE rules SET enabled=? WHERE name=?"
+SQL_DELETE_RULE = "DELETE FROM rules WHERE name=?"
+SQL_DELETE_CONDITIONS = "DELETE FROM rule_conditions WHERE rule_name=?"
+SQL_DELETE_ACTIONS = "DELETE FROM rule_actions WHERE rule_name=?"
+SQL_UPDATE_TRIGGER = ("UPDATE rules SET trigger_count=trigger_count+1, "
+                      "last_triggered=? WHERE name=?")
+SQL_INSERT_EXEC = ("INSERT INTO executions "
+                   "(rule_name, triggered_by, context, result, error, ts, duration_ms) "
+                   "VALUES (?,?,?,?,?,?,?)")
+SQL_INSERT_LOG = "INSERT INTO logs (level, message, context, ts) VALUES (?,?,?,?)"
+
+
 def _get_conn(db_path: str) -> sqlite3.Connection:
-    conn = sqlite3.connect(db_path)
+    """Open a connection in autocommit mode; transactions are explicit."""
+    conn = sqlite3.connect(db_path, check_same_thread=False,
+                           isolation_level=None, cached_statements=256)
     conn.row_factory = sqlite3.Row
     conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA busy_timeout=5000")   # writers queue inside SQLite
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-16000")          # ~16 MB page cache
+    conn.execute("PRAGMA mmap_size=268435456")        # 256 MB memory map
+    conn.execute("PRAGMA journal_size_limit=6144000")
+    conn.execute("PRAGMA wal_autocheckpoint=1000")
     return conn
 
 
-def init_db(db_path: str = DB_PATH) -> None:
-    with _get_conn(db_path) as conn:
-        conn.executescript("""
+def _tuple_cursor(conn: sqlite3.Connection) -> sqlite3.Cursor:
+    """Cursor yielding plain tuples, bypassing the connection's sqlite3.Row."""
+    cur = conn.cursor()
+    cur.row_factory = None
+    return cur
+
+
+def _write_rule(conn: sqlite3.Connection, rule: Rule) -> None:
+    """Store rule across rules/rule_conditions/rule_actions (caller owns tx)."""
+    name = rule.name
+    conn.execute(SQL_DELETE_CONDITIONS, (name,))
+    conn.execute(SQL_DELETE_ACTIONS, (name,))
+    conn.execute(
+        SQL_INSERT_RULE,
+        (name, _enum_value(rule.trigger.type), _dumps(rule.trigger.config),
+         int(rule.enabled), rule.priority, rule.description,
+         rule.created_at, rule.last_triggered, rule.trigger_count)
+    )
+    conn.executemany(SQL_INSERT_CONDITION, [
+        (name, i, c.field, _enum_value(c.op), _dumps(c.value), int(c.negate))
+        for i, c in enumerate(rule.conditions)
+    ])
+    conn.executemany(SQL_INSERT_ACTION, [
+        (name, i, _enum_value(a.type), a.target, _dumps(a.params))
+        for i, a in enumerate(rule.actions)
+    ])
+
+
+def _rules_from_rows(rows: List[tuple], cond_rows: List[tuple],
+                     action_rows: List[tuple]) -> List[Rule]:
+    """Assemble Rules from rule tuples plus their idx-ordered child tuples.
+
+    Rows are positional (no sqlite3.Row) in the SQL_SELECT_* column order.
+    """
+    conditions: Dict[str, List[Condition]] = {}
+    broken = set()
+    for rule_name, fld, op, value, negate in cond_rows:
+        try:
+            cond = Condition(field=fld, op=op, value=_loads(value),
+                             negate=bool(negate))
+        except ValueError as e:
+            # One unreadable rule must not take every other rule down with it
+            if rule_name not in broken:
+                logger.warning("Skipping rule %s: %s", rule_name, e)
+                broken.add(rule_name)
+            continue
+        conditions.setdefault(rule_name, []).append(cond)
+    actions: Dict[str, List[Action]] = {}
+    for rule_name, atype, target, params in action_rows:
+        actions.setdefault(rule_name, []).append(Action(
+            type=atype, target=target, params=_loads(params)))
+    return [
+        Rule(name=name,
+             trigger=Trigger(type=ttype, config=_loads(tconfig)),
+             conditions=conditions.get(name, []),
+             actions=actions.get(name, []),
+             enabled=bool(enabled), priority=priority,
+             description=description, created_at=created_at,
+             last_triggered=last_triggered, trigger_count=trigger_count)
+        for (name, ttype, tconfig, enabled, priority, description,
+             created_at, last_triggered, trigger_count) in rows
+        if name not in broken
+    ]
+
+
+def _write_raw_rule(conn: sqlite3.Connection, d: dict,
+                    row: sqlite3.Row) -> None:
+    """Store a legacy definition that no longer parses as a Rule, disabled."""
+    name = row["name"]
+    trigger = d["trigger"]
+    conn.execute(
+        SQL_INSERT_RULE,
+        (name, _enum_value(trigger["type"]), _dumps(trigger.get("config", {})),
+         0, row["priority"], d.get("description", ""), row["created_at"],
+         row["last_triggered"], row["trigger_count"])
+    )
+    conn.executemany(SQL_INSERT_CONDITION, [
+        (name, i, c["field"], _enum_value(c["op"]), _dumps(c.get("value")),
+         int(c.get("negate", False)))
+        for i, c in enumerate(d.get("conditions", []))
+    ])
+    conn.executemany(SQL_INSERT_ACTION, [
+        (name, i, _enum_value(a["type"]), a.get("target"),
+         _dumps(a.get("params", {})))
+        for i, a in enumerate(d.get("actions", []))
+    ])
+
+
+def _migrate_definition_blobs(conn: sqlite3.Connection) -> None:
+    """Move rules stored as a JSON `definition` blob into the split tables."""
+    cols = {r["name"] for r in conn.execute("PRAGMA table_info(rules)")}
+    if "definition" in cols:
+        # Keep executions' foreign key pointing at "rules" across the rename
+        conn.execute("PRAGMA legacy_alter_table=ON")
+        conn.execute("ALTER TABLE rules RENAME TO rules_legacy")
+        conn.execute("PRAGMA legacy_alter_table=OFF")
+    if not conn.execute("SELECT 1 FROM sqlite_master "
+                        "WHERE type='table' AND name='rules_legacy'").fetchone():
+        return
+    conn.executescript(_SCHEMA)
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        for row in conn.execute("SELECT * FROM rules_legacy").fetchall():
+            d = _loads(row["definition"])
+            try:
+                rule = Rule.from_dict(d)
+            except ValueError as e:
+                # Older code accepted any operator; keep such a rule, disabled
+                logger.warning("Rule %s disabled during migration: %s",
+                               row["name"], e)
+                _write_raw_rule(conn, d, row)
+                continue
+            rule.enabled = bool(row["enabled"])
+            rule.last_triggered = row["last_triggered"]
+            rule.trigger_count = row["trigger_count"]
+            _write_rule(conn, rule)
+        conn.execute("DROP TABLE rules_legacy")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    conn.execute("COMMIT")
+    logger.info("automation_hub migrated rule definitions to split tables")
+
+
+_SCHEMA = """
         CREATE TABLE IF NOT EXISTS rules (
             name        TEXT PRIMARY KEY,
-            definition  TEXT NOT NULL,
+            trigger_type   TEXT NOT NULL,
+            trigger_config TEXT NOT NULL DEFAULT '{}',
             enabled     INTEGER NOT NULL DEFAULT 1,
             priority    INTEGER NOT NULL DEFAULT 0,
+            description TEXT NOT NULL DEFAULT '',
             created_at  TEXT NOT NULL,
             last_triggered TEXT,
             trigger_count  INTEGER NOT NULL DEFAULT 0
         );
+        CREATE INDEX IF NOT EXISTS idx_rules_active ON rules(enabled, priority DESC);
+        CREATE TABLE IF NOT EXISTS rule_conditions (
+            rule_name   TEXT NOT NULL,
+            idx         INTEGER NOT NULL,
+            field       TEXT NOT NULL,
+            op          TEXT NOT NULL,
+            value       TEXT NOT NULL,
+            negate      INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY(rule_name, idx),
+            FOREIGN KEY(rule_name) REFERENCES rules(name)
+        );
+        CREATE TABLE IF NOT EXISTS rule_actions (
+            rule_name   TEXT NOT NULL,
+            idx         INTEGER NOT NULL,
+            type        TEXT NOT NULL,
+            target      TEXT,
+            params      TEXT NOT NULL DEFAULT '{}',
+            PRIMARY KEY(rule_name, idx),
+            FOREIGN KEY(rule_name) REFERENCES rules(name)
+        );
         CREATE TABLE IF NOT EXISTS executions (
             id          INTEGER PRIMARY KEY AUTOINCREMENT,
             rule_name   TEXT NOT NULL,
@@ -182,6 +636,7 @@ def init_db(db_path: str = DB_PATH) -> None:
             FOREIGN KEY(rule_name) REFERENCES rules(name)
         );
         CREATE INDEX IF NOT EXISTS idx_exec_rule ON executions(rule_name, ts);
+        CREATE INDEX IF NOT EXISTS idx_exec_ts ON executions(ts DESC);
         CREATE TABLE IF NOT EXISTS logs (
             id          INTEGER PRIMARY KEY AUTOINCREMENT,
             level       TEXT NOT NULL DEFAULT 'INFO',
@@ -189,93 +644,258 @@ def init_db(db_path: str = DB_PATH) -> None:
             context     TEXT NOT NULL DEFAULT '{}',
             ts          TEXT NOT NULL
         );
-        """)
+"""
+
+
+def init_db(db_path: str = DB_PATH) -> None:
+    conn = _get_conn(db_path)
+    try:
+        _migrate_definition_blobs(conn)
+        conn.executescript(_SCHEMA)
+    finally:
+        conn.close()
     logger.info("automation_hub DB initialised at %s", db_path)
 
 
 # ─────────────────────────── Engine ─────────────────────────────────
 
+@dataclass(frozen=True)
+class _RuleSnapshot:
+    """Enabled rules plus every index derived from them, built together.
+
+    Dispatch reads all of its lookups from one snapshot so a concurrent rule
+    change can never pair a fresh rule list with stale indexes.
+    """
+    rules: List[Rule]                        # by descending priority
+    by_trigger: Dict[str, List[Rule]]
+    by_sensor: Dict[Any, List[Rule]]         # see _index_by_config
+    by_event: Dict[Any, List[Rule]]
+    thresholds: Dict[str, _ThresholdTable]
+
+    def for_sensor(self, sensor_id: str) -> List[Rule]:
+        bucket = self.by_sensor.get(sensor_id)
+        return self.by_sensor[None] if bucket is None else bucket
+
+    def for_event(self, event_name: str) -> List[Rule]:
+        bucket = self.by_event.get(event_name)
+        return self.by_event[None] if bucket is None else bucket
+
+
 class AutomationHub:
     def __init__(self, db_path: str = DB_PATH):
         self.db_path = db_path
         init_db(db_path)
         self._service_handlers: Dict[str, Callable[[str, Dict], Any]] = {}
         self._running = False
+        self._tls = threading.local()
+        # DELAY actions park the rest of a rule's actions here:
+        # heap of (due monotonic time, seq, rule name, remaining actions, context)
+        self._delayed: List[Tuple[float, int, str, List[Action], Dict[str, Any]]] = []
+        self._delay_seq = itertools.count()
+        self._delay_cv = threading.Condition()
+        self._delay_worker: Optional[threading.Thread] = None
+        self._delay_stop: Optional[threading.Event] = None   # the worker's own
+        # Enabled rules, priority-ordered, rebuilt lazily after any rule change
+        self._rule_cache: Optional[_RuleSnapshot] = None
+        self._rule_cache_version = 0
+        self._rule_cache_lock = threading.Lock()
+
+    # ── Connection handling ───────────────────────────────────────────
+
+    def _conn(self) -> sqlite3.Connection:
+        """Per-thread cached connection; pragmas are applied once on open."""
+        conn = getattr(self._tls, "conn", None)
+        if conn is None:
+            conn = self._tls.conn = _get_conn(self.db_path)
+        return conn
+
+    def _queues(self) -> Tuple[Deque[tuple], Deque[tuple]]:
+        """This thread's (execution, log) row queues.
+
+        Rows are queued per thread so a transaction only ever commits (or
+        discards) rows its own thread produced.
+        """
+        queues = getattr(self._tls, "queues", None)
+        if queues is None:
+            queues = self._tls.queues = (deque(), deque())
+        return queues
+
+    @contextmanager
+    def _tx(self, mode: str = "IMMEDIATE") -> Iterator[sqlite3.Connection]:
+        """Transaction (write by default); joins the enclosing one if open.
+
+        Reads spanning several statements use mode="DEFERRED" for a
+        consistent snapshot without taking the write lock. Queued rows are
+        only drained by write transactions: a read snapshot that tried to
+        write would have to upgrade, which WAL answers with SQLITE_BUSY.
+        """
+        conn = self._conn()
+        if conn.in_transaction:
+            yield conn
+            return
+        conn.execute(f"BEGIN {mode}")
+        try:
+            yield conn
+            if mode == "IMMEDIATE":
+                self._drain_queues(conn)
+        except BaseException:
+            conn.execute("ROLLBACK")
+            # Rows queued by the rolled-back work describe nothing that stuck
+            for queue in self._queues():
+                queue.clear()
+            raise
+        conn.execute("COMMIT")
+
+    def _drain_queues(self, conn: sqlite3.Connection) -> None:
+        """Bulk-insert this thread's queued log/execution rows on conn."""
+        exec_queue, log_queue = self._queues()
+        for queue, sql in ((exec_queue, SQL_INSERT_EXEC),
+                           (log_queue, SQL_INSERT_LOG)):
+            while queue:
+                rows = [queue.popleft()
+                        for _ in range(min(len(queue), _FLUSH_BATCH))]
+                conn.executemany(sql, rows)
+
+    def flush(self) -> None:
+        """Write the calling thread's queued log/execution rows now."""
+        exec_queue, log_queue = self._queues()
+        if exec_queue or log_queue:
+            with self._tx() as conn:
+                self._drain_queues(conn)
+
+    def _queue_row(self, queue: Deque[tuple], row: tuple) -> None:
+        queue.append(row)
+        # Outside a transaction nothing else will commit the row for us
+        if not self._conn().in_transaction:
+            self.flush()
+
+    def close(self) -> None:
+        """Stop the delay worker, flush queued rows and close the calling
+        thread's cached connection."""
+        self._stop_delay_worker()
+        self._close_conn()
+
+    def _close_conn(self) -> None:
+        conn = getattr(self._tls, "conn", None)
+        if conn is not None:
+            # ANALYZE may write: take the write lock up front, so the busy
+            # timeout applies rather than a failed read-to-write upgrade
+            with self._tx():
+                conn.execute("PRAGMA optimize")
+            conn.close()
+            self._tls.conn = None
 
     # ── Rule management ───────────────────────────────────────────────
 
     def add_rule(self, rule: Rule) -> Rule:
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute(
-                "INSERT OR REPLACE INTO rules VALUES (?,?,?,?,?,?,?)",
-                (rule.name, json.dumps(rule.to_dict()),
-                 int(rule.enabled), rule.priority,
-                 rule.created_at, rule.last_triggered,
-                 rule.trigger_count)
-            )
-        self._log("INFO", f"Rule added: {rule.name}", {})
+        with self._tx() as conn:
+            _write_rule(conn, rule)
+            self._log("INFO", f"Rule added: {rule.name}", {})
+        self._invalidate_rules()
         return rule
 
     def add_rule_from_json(self, rule_json: str) -> Rule:
-        d = json.loads(rule_json)
+        d = _loads(rule_json)
         rule = Rule.from_dict(d)
         return self.add_rule(rule)
 
     def get_rule(self, name: str) -> Optional[Rule]:
-        with _get_conn(self.db_path) as conn:
-            row = conn.execute(
-                "SELECT * FROM rules WHERE name=?", (name,)
-            ).fetchone()
-        if not row:
-            return None
-        r = Rule.from_dict(json.loads(row["definition"]))
-        r.enabled = bool(row["enabled"])
-        r.last_triggered = row["last_triggered"]
-        r.trigger_count = row["trigger_count"]
-        return r
+        with self._tx("DEFERRED") as conn:
+            cur = _tuple_cursor(conn)
+            row = cur.execute(SQL_SELECT_RULE, (name,)).fetchone()
+            if not row:
+                return None
+            conds = cur.execute(SQL_SELECT_CONDITIONS, (name,)).fetchall()
+            acts = cur.execute(SQL_SELECT_ACTIONS, (name,)).fetchall()
+        rules = _rules_from_rows([row], conds, acts)
+        return rules[0] if rules else None
 
     def enable_rule(self, name: str) -> None:
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute(
-                "UPDATE rules SET enabled=1 WHERE name=?", (name,)
-            )
+        with self._tx() as conn:
+            conn.execute(SQL_SET_ENABLED, (1, name))
+        self._invalidate_rules()
 
     def disable_rule(self, name: str) -> None:
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute(
-                "UPDATE rules SET enabled=0 WHERE name=?", (name,)
-            )
+        with self._tx() as conn:
+            conn.execute(SQL_SET_ENABLED, (0, name))
+        self._invalidate_rules()
 
     def delete_rule(self, name: str) -> None:
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute("DELETE FROM rules WHERE name=?", (name,))
+        with self._tx() as conn:
+            conn.execute(SQL_DELETE_CONDITIONS, (name,))
+            conn.execute(SQL_DELETE_ACTIONS, (name,))
+            conn.execute(SQL_DELETE_RULE, (name,))
+        self._invalidate_rules()
 
     def get_active_rules(self) -> List[Rule]:
-        with _get_conn(self.db_path) as conn:
-            rows = conn.execute(
-                "SELECT * FROM rules WHERE enabled=1 ORDER BY priority DESC"
-            ).fetchall()
-        result = []
-        for row in rows:
-            r = Rule.from_dict(json.loads(row["definition"]))
-            r.enabled = True
-            r.last_triggered = row["last_triggered"]
-            r.trigger_count = row["trigger_count"]
-            result.append(r)
-        return result
+        """Enabled rules by descending priority, served from the rule cache.
+
+        Returns copies, so callers can't alter the engine's cached rules. The
+        cache only tracks changes made through this hub instance.
+        """
+        rules = copy.deepcopy(self._load_rules().rules)
+        for r in rules:
+            # Compiled from the cached conditions; edits to a copy's own
+            # conditions must not be judged by it
+            r._eval_fn = None
+        return rules
+
+    def _load_rules(self) -> _RuleSnapshot:
+        """Current rule snapshot; dispatch must use only this one object."""
+        snapshot = self._rule_cache
+        if snapshot is not None:
+            return snapshot
+        version = self._rule_cache_version
+        with self._tx("DEFERRED") as conn:
+            cur = _tuple_cursor(conn)
+            rules = _rules_from_rows(
+                cur.execute(SQL_SELECT_ACTIVE).fetchall(),
+                cur.execute(SQL_SELECT_ACTIVE_CONDITIONS).fetchall(),
+                cur.execute(SQL_SELECT_ACTIVE_ACTIONS).fetchall())
+        by_trigger: Dict[str, List[Rule]] = {}
+        for r in rules:
+            if r.conditions:
+                r._eval_fn = _compile_conditions(r)
+            by_trigger.setdefault(_enum_value(r.trigger.type), []).append(r)
+        sensor_rules = by_trigger.get(TriggerType.SENSOR.value, [])
+        snapshot = _RuleSnapshot(
+            rules=rules,
+            by_trigger=by_trigger,
+            by_sensor=_index_by_config(sensor_rules, "sensor_id"),
+            by_event=_index_by_config(
+                by_trigger.get(TriggerType.EVENT.value, []), "event_name"),
+            thresholds=_build_threshold_tables(sensor_rules),
+        )
+        # A rule change while we were reading makes this snapshot stale for
+        # later callers; it is still served to this one, as a whole.
+        with self._rule_cache_lock:
+            if version == self._rule_cache_version:
+                self._rule_cache = snapshot
+        return snapshot
+
+    def _invalidate_rules(self) -> None:
+        with self._rule_cache_lock:
+            self._rule_cache_version += 1
+            self._rule_cache = None
 
     def list_rules(self) -> List[Dict[str, Any]]:
-        with _get_conn(self.db_path) as conn:
-            rows = conn.execute(
-                "SELECT name, enabled, priority, last_triggered, trigger_count "
-                "FROM rules ORDER BY priority DESC"
-            ).fetchall()
+        rows = self._conn().execute(
+            "SELECT name, enabled, priority, last_triggered, trigger_count "
+            "FROM rules ORDER BY priority DESC"
+        ).fetchall()
         return [dict(r) for r in rows]
 
     # ── Condition & Action evaluation ─────────────────────────────────
 
     def evaluate_rule(self, rule: Rule, context: Dict[str, Any]) -> Tuple[bool, List[str]]:
         """Returns (should_run, [failed_condition_descriptions])"""
+        fast = rule._eval_fn
+        if fast is not None:
+            try:
+                if fast(context):
+                    return True, []
+            except Exception:
+                pass   # the per-condition pass below reports the error
         failed = []
         for cond in rule.conditions:
             try:
@@ -316,10 +936,9 @@ class AutomationHub:
             return {"service": service, "status": "no_handler"}
 
         if atype == ActionType.DELAY:
-            import time
+            # The engine parks the rule's remaining actions until then
             secs = action.params.get("seconds", 1)
-            time.sleep(secs)
-            return {"delayed": secs}
+            return {"delayed": secs, "deferred_until": time.monotonic() + secs}
 
         if atype == ActionType.RUN_SCENE:
             scene = action.params.get("scene_name")
@@ -335,78 +954,178 @@ class AutomationHub:
 
     def run_rule_engine(self, context: Dict[str, Any],
                         trigger_type: Optional[str] = None) -> List[Dict[str, Any]]:
-        rules = self.get_active_rules()
         if trigger_type:
-            rules = [r for r in rules if r.trigger.type == trigger_type]
+            rules = self._load_rules().by_trigger.get(_enum_value(trigger_type), [])
+        else:
+            rules = self._load_rules().rules
+        return self._run_rules(rules, context, trigger_type)
+
+    def _run_rules(self, rules: List[Rule], context: Dict[str, Any],
+                   trigger_type: Optional[str],
+                   verdicts: Optional[Dict[int, List[str]]] = None) -> List[Dict[str, Any]]:
+        """Run a pass over rules.
+
+        verdicts maps id(rule) → failed condition descriptions already worked
+        out by the caller; rules missing from it are evaluated normally.
+        """
         results = []
-        for rule in rules:
-            start = datetime.utcnow()
-            ok, failed = self.evaluate_rule(rule, context)
-            if not ok:
-                results.append({"rule": rule.name, "status": "skipped",
-                                 "failed_conditions": failed})
-                continue
-            action_results = []
-            error_msg = None
+        fired: List[Tuple[Rule, str]] = []
+        # One transaction per pass: executions, trigger counts and action
+        # logs for every rule are committed together.
+        with self._tx():
+            for rule in rules:
+                start = time.perf_counter()
+                failed = verdicts.get(id(rule)) if verdicts else None
+                if failed is None:
+                    ok, failed = self.evaluate_rule(rule, context)
+                else:
+                    ok = not failed
+                if not ok:
+                    results.append({"rule": rule.name, "status": "skipped",
+                                     "failed_conditions": failed})
+                    continue
+                action_results = []
+                error_msg = None
+                try:
+                    for i, action in enumerate(rule.actions):
+                        res = self.execute_action(action, context)
+                        action_results.append(res)
+                        if action.type == ActionType.DELAY:
+                            self._defer(res["deferred_until"], rule.name,
+                                        rule.actions[i + 1:], context)
+                            break
+                    status = "ok"
+                except Exception as e:
+                    status = "error"
+                    error_msg = str(e)
+                    logger.error("Rule %s action error: %s", rule.name, e)
+
+                duration_ms = (time.perf_counter() - start) * 1000
+                self._record_execution(rule.name, trigger_type or "manual",
+                                       context, status, error_msg, duration_ms)
+                fired.append((rule, self._increment_trigger(rule.name)))
+                results.append({
+                    "rule": rule.name, "status": status,
+                    "actions": action_results, "duration_ms": round(duration_ms, 2)
+                })
+        # Mirror the committed counters onto the cached rules; a rolled-back
+        # pass raises out of the block above and never gets here.
+        with self._rule_cache_lock:
+            for rule, ts in fired:
+                rule.last_triggered = ts
+                rule.trigger_count += 1
+        return results
+
+    # ── Delayed actions ───────────────────────────────────────────────
+
+    def _defer(self, due: float, rule_name: str, actions: List[Action],
+               context: Dict[str, Any]) -> None:
+        if not actions:
+            return
+        # The worker runs later, on another thread; it must not see (or race
+        # with) whatever the caller does to its context dict afterwards.
+        context = copy.deepcopy(context)
+        with self._delay_cv:
+            heapq.heappush(self._delayed,
+                           (due, next(self._delay_seq), rule_name, actions, context))
+            if self._delay_worker is None:
+                # Each worker gets its own stop flag, so stopping one can't be
+                # undone by a later _defer starting its successor.
+                self._delay_stop = threading.Event()
+                self._delay_worker = threading.Thread(
+                    target=self._delay_loop, args=(self._delay_stop,),
+                    name="automation-hub-delay", daemon=True)
+                self._delay_worker.start()
+            self._delay_cv.notify_all()
+
+    def _delay_loop(self, stop: threading.Event) -> None:
+        try:
+            while True:
+                with self._delay_cv:
+                    while not stop.is_set():
+                        if self._delayed:
+                            wait = self._delayed[0][0] - time.monotonic()
+                            if wait <= 0:
+                                break
+                        else:
+                            wait = None
+                        self._delay_cv.wait(wait)
+                    if stop.is_set():
+                        return
+                    _, _, rule_name, actions, context = heapq.heappop(self._delayed)
+                self._run_deferred(rule_name, actions, context)
+        finally:
+            self._close_conn()
+
+    def _run_deferred(self, rule_name: str, actions: List[Action],
+                      context: Dict[str, Any]) -> None:
+        """Resume a rule's actions after a DELAY, on the delay worker."""
+        with self._tx():
             try:
-                for action in rule.actions:
+                for i, action in enumerate(actions):
                     res = self.execute_action(action, context)
-                    action_results.append(res)
-                status = "ok"
+                    if action.type == ActionType.DELAY:
+                        self._defer(res["deferred_until"], rule_name,
+                                    actions[i + 1:], context)
+                        return
             except Exception as e:
-                status = "error"
-                error_msg = str(e)
-                logger.error("Rule %s action error: %s", rule.name, e)
-
-            duration_ms = (datetime.utcnow() - start).total_seconds() * 1000
-            self._record_execution(rule.name, trigger_type or "manual",
-                                   context, status, error_msg, duration_ms)
-            self._increment_trigger(rule.name)
-            results.append({
-                "rule": rule.name, "status": status,
-                "actions": action_results, "duration_ms": round(duration_ms, 2)
-            })
-        return results
+                logger.error("Rule %s delayed action error: %s", rule_name, e)
+                self._log("ERROR", f"[rule_action] {rule_name}: {e}", context)
+
+    def _stop_delay_worker(self) -> None:
+        with self._delay_cv:
+            worker, self._delay_worker = self._delay_worker, None
+            stop, self._delay_stop = self._delay_stop, None
+            if stop is not None:
+                stop.set()
+            if self._delayed:
+                logger.warning("Dropping %d delayed action chain(s) on close",
+                               len(self._delayed))
+                self._delayed.clear()
+            self._delay_cv.notify_all()
+        if worker is not None and worker is not threading.current_thread():
+            worker.join()
 
     def fire_event(self, event_name: str,
                    event_data: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
         context = {"event": {"name": event_name, "data": event_data or {}},
-                   "ts": datetime.utcnow().isoformat()}
-        return self.run_rule_engine(context, trigger_type=TriggerType.EVENT)
+                   "ts": _now_iso()}
+        rules = self._load_rules().for_event(event_name)
+        return self._run_rules(rules, context, TriggerType.EVENT)
 
     def process_sensor_update(self, sensor_id: str,
                               value: float, unit: str = "") -> List[Dict[str, Any]]:
         context = {
             "sensor": {sensor_id: {"value": value, "unit": unit}},
             "event": {"name": "sensor_update", "sensor_id": sensor_id, "value": value},
-            "ts": datetime.utcnow().isoformat()
+            "ts": _now_iso()
         }
-        return self.run_rule_engine(context, trigger_type=TriggerType.SENSOR)
+        snapshot = self._load_rules()
+        rules = snapshot.for_sensor(sensor_id)
+        table = snapshot.thresholds.get(sensor_id)
+        verdicts = table.match(value) if table and _is_number(value) else None
+        return self._run_rules(rules, context, TriggerType.SENSOR, verdicts)
 
     # ── Execution history ─────────────────────────────────────────────
 
     def _record_execution(self, rule_name: str, triggered_by: str,
                           context: Dict[str, Any], result: str,
                           error: Optional[str], duration_ms: float) -> None:
-        ts = datetime.utcnow().isoformat()
-        safe_context = {k: v for k, v in context.items() if k != "credentials"}
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute(
-                "INSERT INTO executions "
-                "(rule_name, triggered_by, context, result, error, ts, duration_ms) "
-                "VALUES (?,?,?,?,?,?,?)",
-                (rule_name, triggered_by, json.dumps(safe_context),
-                 result, error, ts, duration_ms)
-            )
-
-    def _increment_trigger(self, rule_name: str) -> None:
-        now = datetime.utcnow().isoformat()
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute(
-                "UPDATE rules SET trigger_count=trigger_count+1, last_triggered=? "
-                "WHERE name=?",
-                (now, rule_name)
-            )
+        ts = _now_iso()
+        if _REDACT_KEYS & context.keys():
+            safe_context = {k: v for k, v in context.items()
+                            if k not in _REDACT_KEYS}
+        else:
+            safe_context = context
+        self._queue_row(self._queues()[0],
+                        (rule_name, triggered_by, _dumps(safe_context),
+                         result, error, ts, duration_ms))
+
+    def _increment_trigger(self, rule_name: str) -> str:
+        now = _now_iso()
+        with self._tx() as conn:
+            conn.execute(SQL_UPDATE_TRIGGER, (now, rule_name))
+        return now
 
     def get_execution_history(self, rule_name: Optional[str] = None,
                               hours: int = 24) -> List[Dict[str, Any]]:
@@ -416,20 +1135,16 @@ class AutomationHub:
         if rule_name:
             q += " AND rule_name=?"
             params.append(rule_name)
-        q += " ORDER BY ts DESC"
-        with _get_conn(self.db_path) as conn:
-            rows = conn.execute(q, params).fetchall()
+        q += " ORDER BY ts DESC, id DESC"
+        rows = self._conn().execute(q, params).fetchall()
         return [dict(r) for r in rows]
 
     # ── Logging ───────────────────────────────────────────────────────
 
     def _log(self, level: str, message: str, context: Dict[str, Any]) -> None:
-        ts = datetime.utcnow().isoformat()
-        with _LOCK, _get_conn(self.db_path) as conn:
-            conn.execute(
-                "INSERT INTO logs (level, message, context, ts) VALUES (?,?,?,?)",
-                (level, message, json.dumps(context), ts)
-            )
+        ts = _now_iso()
+        self._queue_row(self._queues()[1],
+                        (level, message, _dumps(context), ts))
 
 
 # ──────────────────────────── Demo ──────────────────────────────────
@@ -1,5 +1,6 @@
 """Tests for blackroad-automation-hub."""
-import json, pytest
+import json, pickle, sqlite3, threading, time, pytest
+import automation_hub
 from automation_hub import (
     AutomationHub, Rule, Trigger, Condition, Action,
     TriggerType, ActionType
@@ -97,3 +98,330 @@ def test_execution_history(hub):
     hub.process_sensor_update("t1", 50.0, "°C")
     hist = hub.get_execution_history("temp_alert")
     assert len(hist) >= 1
+
+
+def test_queued_logs_flushed_after_pass(hub):
+    hub.process_sensor_update("t1", 50.0, "°C")
+    with sqlite3.connect(hub.db_path) as conn:
+        msgs = [r[0] for r in conn.execute("SELECT message FROM logs")]
+        n_exec = conn.execute("SELECT COUNT(*) FROM executions").fetchone()[0]
+    assert "[rule_action] hot!" in msgs
+    assert n_exec == 1
+
+
+def test_condition_missing_or_non_dict_path():
+    cond = Condition(field="sensor.t1.value", op=">", value=30)
+    assert cond.evaluate({"sensor": {}}) is False
+    assert cond.evaluate({"sensor": {"t1": 42}}) is False
+    negated = Condition(field="sensor.t1.value", op=">", value=30, negate=True)
+    assert negated.evaluate({"sensor": "offline"}) is True
+
+
+def test_rule_cache_invalidated_on_change(hub):
+    assert len(hub.process_sensor_update("t1", 40.0, "°C")) == 1
+    hub.disable_rule("temp_alert")
+    assert hub.process_sensor_update("t1", 40.0, "°C") == []
+    hub.enable_rule("temp_alert")
+    hub.process_sensor_update("t1", 40.0, "°C")
+    cached = hub.get_active_rules()[0]
+    assert cached.trigger_count == hub.get_rule("temp_alert").trigger_count == 2
+
+
+def test_unknown_operator_rejected_at_construction():
+    with pytest.raises(ValueError):
+        Condition(field="sensor.t1.value", op="~=", value=1)
+
+
+def test_condition_reflects_later_field_and_op_changes():
+    cond = Condition(field="sensor.t1.value", op=">", value=30)
+    cond.op = "<"
+    assert cond.evaluate({"sensor": {"t1": {"value": 10}}}) is True
+    cond.field = "x"
+    assert cond.evaluate({"x": 10, "sensor": {"t1": {"value": 50}}}) is True
+    with pytest.raises(ValueError):
+        cond.op = "~="
+    assert cond.op == "<"
+
+
+def test_sensor_threshold_table_matches_generic_eval(hub):
+    hub.add_rule(Rule(
+        name="warm_band",
+        trigger=Trigger(type=TriggerType.SENSOR, config={"sensor_id": "t1"}),
+        conditions=[Condition(field="sensor.t1.value", op=">=", value=20),
+                    Condition(field="sensor.t1.value", op="<", value=30)],
+        actions=[Action(type=ActionType.LOG_MESSAGE, params={"message": "warm"})],
+    ))
+    for value, expected in ((25.0, {"warm_band"}), (35.0, {"temp_alert"}),
+                            (10.0, set())):
+        results = hub.process_sensor_update("t1", value)
+        assert {r["rule"] for r in results if r["status"] == "ok"} == expected
+    skipped = [r for r in hub.process_sensor_update("t1", 10.0)
+               if r["rule"] == "warm_band"]
+    assert skipped[0]["failed_conditions"] == ["sensor.t1.value >= 20"]
+
+
+def test_rule_round_trips_through_split_tables(hub):
+    hub.add_rule(Rule(
+        name="porch",
+        trigger=Trigger(type=TriggerType.STATE, config={"entity_id": "door.front"}),
+        conditions=[Condition(field="state.mode", op="in", value=["away", "night"],
+                              negate=True)],
+        actions=[Action(type=ActionType.SET_STATE, target="light.porch",
+                        params={"state": "on"})],
+        priority=2, description="porch light",
+    ))
+    r = hub.get_rule("porch")
+    assert r.trigger.config == {"entity_id": "door.front"}
+    assert r.conditions[0].value == ["away", "night"] and r.conditions[0].negate
+    assert r.actions[0].target == "light.porch" and r.description == "porch light"
+    hub.delete_rule("porch")
+    assert hub.get_rule("porch") is None
+
+
+def test_concurrent_sensor_updates(hub):
+    n_threads, n_updates = 8, 25
+    start = threading.Barrier(n_threads)
+    errors = []
+
+    def worker():
+        start.wait()
+        try:
+            for _ in range(n_updates):
+                hub.process_sensor_update("t1", 45.0)
+                hub.get_rule("temp_alert")
+        except Exception as e:   # surfaced below; threads swallow exceptions
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(n_threads)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    total = n_threads * n_updates
+    assert errors == []
+    assert hub.get_rule("temp_alert").trigger_count == total
+    assert len(hub.get_execution_history("temp_alert")) == total
+    with sqlite3.connect(hub.db_path) as conn:
+        n_logs = conn.execute("SELECT COUNT(*) FROM logs "
+                              "WHERE message='[rule_action] hot!'").fetchone()[0]
+    assert n_logs == total
+
+
+def test_dispatch_by_sensor_and_event(hub):
+    hub.add_rule(Rule(
+        name="t2_alert",
+        trigger=Trigger(type=TriggerType.SENSOR, config={"sensor_id": "t2"}),
+        conditions=[Condition(field="sensor.t2.value", op=">", value=0)],
+    ))
+    hub.add_rule(Rule(name="any_event", trigger=Trigger(type=TriggerType.EVENT)))
+    hub.add_rule(Rule(
+        name="door_open",
+        trigger=Trigger(type=TriggerType.EVENT, config={"event_name": "door"}),
+    ))
+    assert [r["rule"] for r in hub.process_sensor_update("t1", 50.0)] == ["temp_alert"]
+    assert [r["rule"] for r in hub.process_sensor_update("t2", 1.0)] == ["t2_alert"]
+    assert {r["rule"] for r in hub.fire_event("door")} == {"any_event", "door_open"}
+    assert [r["rule"] for r in hub.fire_event("motion")] == ["any_event"]
+
+
+def test_rule_to_dict_omits_derived_fields(hub):
+    d = hub.get_rule("temp_alert").to_dict()
+    assert set(d["conditions"][0]) == {"field", "op", "value", "negate"}
+    assert Rule.from_dict(json.loads(json.dumps(d))).name == "temp_alert"
+
+
+def test_compiled_conditions_agree_with_slow_path(hub):
+    rule = hub._load_rules().rules[0]
+    assert rule._eval_fn is not None
+    assert hub.evaluate_rule(rule, {"sensor": {"t1": {"value": 31}}}) == (True, [])
+    assert hub.evaluate_rule(rule, {"sensor": {"t1": {"value": "n/a"}}})[1][0].startswith("error:")
+    assert hub.evaluate_rule(rule, {}) == (False, ["sensor.t1.value > 30.0"])
+
+
+def test_operator_without_inline_form_still_compiles(hub, monkeypatch):
+    monkeypatch.setitem(automation_hub._OP_MAP, "startswith",
+                        lambda a, b: a.startswith(b))
+    hub.add_rule(Rule(
+        name="kitchen_motion",
+        trigger=Trigger(type=TriggerType.EVENT, config={"event_name": "motion"}),
+        conditions=[Condition(field="event.data.room", op="startswith", value="kit")],
+    ))
+    rule = hub._load_rules().by_trigger["event"][0]
+    assert rule._eval_fn is not None
+    assert hub.fire_event("motion", {"room": "kitchen"})[0]["status"] == "ok"
+    assert hub.fire_event("motion", {"room": "hall"})[0]["status"] == "skipped"
+
+
+def test_credentials_not_persisted(hub):
+    hub.run_rule_engine({"sensor": {"t1": {"value": 50}}, "credentials": "s3cret"},
+                        trigger_type=TriggerType.SENSOR)
+    ctx = json.loads(hub.get_execution_history("temp_alert")[0]["context"])
+    assert "credentials" not in ctx and ctx["sensor"]["t1"]["value"] == 50
+
+
+def test_delay_defers_remaining_actions(hub):
+    calls = []
+    hub.register_service("chime", lambda name, params: calls.append(params["n"]))
+    hub.add_rule(Rule(
+        name="doorbell",
+        trigger=Trigger(type=TriggerType.EVENT, config={"event_name": "ring"}),
+        actions=[Action(type=ActionType.CALL_SERVICE, target="chime", params={"n": 1}),
+                 Action(type=ActionType.DELAY, params={"seconds": 0.05}),
+                 Action(type=ActionType.CALL_SERVICE, target="chime", params={"n": 2})],
+    ))
+    results = hub.fire_event("ring")
+    assert results[0]["status"] == "ok" and calls == [1]
+    deadline = time.monotonic() + 2
+    while calls != [1, 2] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert calls == [1, 2]
+    hub.close()
+
+
+def test_nan_threshold_left_to_generic_eval(hub):
+    hub.add_rule(Rule(
+        name="nan_band",
+        trigger=Trigger(type=TriggerType.SENSOR, config={"sensor_id": "t1"}),
+        conditions=[Condition(field="sensor.t1.value", op="<=", value=float("nan"))],
+    ))
+    results = {r["rule"]: r["status"] for r in hub.process_sensor_update("t1", 5.0)}
+    assert results["nan_band"] == "skipped"
+
+
+def test_execution_history_newest_first_within_a_second(hub):
+    for _ in range(5):
+        hub.process_sensor_update("t1", 50.0)
+    for name in (None, "temp_alert"):
+        ids = [r["id"] for r in hub.get_execution_history(name)]
+        assert ids == sorted(ids, reverse=True)
+
+
+def test_dispatch_uses_snapshot_even_if_invalidated_mid_load(hub, monkeypatch):
+    real_build = automation_hub._build_threshold_tables
+
+    def build_then_invalidate(rules):
+        hub._invalidate_rules()   # a rule change lands while the cache loads
+        return real_build(rules)
+
+    monkeypatch.setattr(automation_hub, "_build_threshold_tables",
+                        build_then_invalidate)
+    results = hub.process_sensor_update("t1", 50.0)
+    assert [r["status"] for r in results] == ["ok"]
+
+
+def _delay_workers():
+    return {t for t in threading.enumerate() if t.name == "automation-hub-delay"}
+
+
+def test_close_stops_delay_workers_while_events_fire(hub):
+    hub.add_rule(Rule(
+        name="later",
+        trigger=Trigger(type=TriggerType.EVENT, config={"event_name": "go"}),
+        actions=[Action(type=ActionType.DELAY, params={"seconds": 60}),
+                 Action(type=ActionType.LOG_MESSAGE, params={"message": "late"})],
+    ))
+    before = _delay_workers()
+    done = threading.Event()
+
+    def fire():
+        # Each event parks work, restarting the delay worker close() stopped
+        while not done.is_set():
+            hub.fire_event("go")
+        hub.close()
+
+    t = threading.Thread(target=fire)
+    t.start()
+    try:
+        for _ in range(20):
+            hub.close()
+            time.sleep(0.005)
+    finally:
+        done.set()
+        t.join(timeout=5)
+    hub.close()
+    started = _delay_workers() - before
+    for w in started:
+        w.join(timeout=2)
+    assert not t.is_alive() and not any(w.is_alive() for w in started)
+
+
+def test_deferred_actions_see_context_as_it_was(hub):
+    hub.add_rule(Rule(
+        name="later",
+        trigger=Trigger(type=TriggerType.EVENT),
+        actions=[Action(type=ActionType.DELAY, params={"seconds": 0.05}),
+                 Action(type=ActionType.LOG_MESSAGE, params={"message": "late"})],
+    ))
+    context = {"event": {"name": "go"}, "n": 1}
+    hub.run_rule_engine(context, trigger_type=TriggerType.EVENT)
+    context["n"] = 2
+    context["extra"] = True
+    logged = []
+    deadline = time.monotonic() + 2
+    while not logged and time.monotonic() < deadline:
+        time.sleep(0.01)
+        with sqlite3.connect(hub.db_path) as conn:
+            logged = [json.loads(r[0]) for r in conn.execute(
+                "SELECT context FROM logs WHERE message='[rule_action] late'")]
+    assert logged == [{"event": {"name": "go"}, "n": 1}]
+    hub.close()
+
+
+def test_active_rules_are_copies(hub):
+    hub.get_active_rules()[0].conditions.clear()
+    results = hub.process_sensor_update("t1", 10.0)
+    assert results[0]["status"] == "skipped"
+    rule = hub.get_active_rules()[0]
+    rule.conditions[0].value = 100
+    assert hub.evaluate_rule(rule, {"sensor": {"t1": {"value": 50}}})[0] is False
+
+
+def test_cached_counts_untouched_by_rolled_back_pass(hub, monkeypatch):
+    def boom(*args):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(hub, "_record_execution", boom)
+    with pytest.raises(RuntimeError):
+        hub.process_sensor_update("t1", 50.0)
+    assert hub.get_active_rules()[0].trigger_count == 0
+    assert hub.get_rule("temp_alert").trigger_count == 0
+
+
+def test_legacy_definition_blobs_migrated(tmp_path):
+    path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(path)
+    conn.execute("CREATE TABLE rules (name TEXT PRIMARY KEY, definition TEXT NOT NULL, "
+                 "enabled INTEGER NOT NULL DEFAULT 1, priority INTEGER NOT NULL DEFAULT 0, "
+                 "created_at TEXT NOT NULL, last_triggered TEXT, "
+                 "trigger_count INTEGER NOT NULL DEFAULT 0)")
+    for name, op in (("hot", ">"), ("odd", "~=")):
+        d = {"name": name, "priority": 1, "created_at": "2024-01-01T00:00:00",
+             "trigger": {"type": "sensor", "config": {"sensor_id": "t1"}},
+             "conditions": [{"field": "sensor.t1.value", "op": op, "value": 30}],
+             "actions": [{"type": "log_message", "params": {"message": name}}]}
+        conn.execute("INSERT INTO rules VALUES (?,?,?,?,?,?,?)",
+                     (name, json.dumps(d), 1, 1, d["created_at"], None, 3))
+    conn.commit()
+    conn.close()
+
+    h = AutomationHub(db_path=path)
+    assert h.get_rule("hot").trigger_count == 3
+    assert {r["name"]: r["enabled"] for r in h.list_rules()} == {"hot": 1, "odd": 0}
+    # The unreadable rule is skipped, even once re-enabled, not fatal
+    h.enable_rule("odd")
+    assert h.get_rule("odd") is None
+    assert [r["rule"] for r in h.process_sensor_update("t1", 50.0)] == ["hot"]
+    h.close()
+    AutomationHub(db_path=path).close()   # a second start finds nothing to migrate
+
+
+def test_rules_pickle(hub):
+    rule = hub._load_rules().rules[0]
+    rule.conditions.append(Condition(field="sensor.t1.unit", op="in", value=["C", "F"]))
+    clone = pickle.loads(pickle.dumps(rule))
+    assert clone.to_dict() == rule.to_dict()
+    assert clone._eval_fn is None
+    ctx = {"sensor": {"t1": {"value": 31, "unit": "C"}}}
+    assert hub.evaluate_rule(clone, ctx) == (True, [])
+    ctx["sensor"]["t1"]["unit"] = "K"
+    assert hub.evaluate_rule(clone, ctx)[0] is False